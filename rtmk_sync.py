@@ -8,29 +8,74 @@ RTMK 10分CSVを FTP から取得し、data/YYYY-MM.csv に月別で追記する
 - FTP_HOST, FTP_USER, FTP_PASS, FTP_DIR(任意), FTP_PORT(任意)
 - START_FROM_DATE (任意, 例: 2025-11-01)
 - REBUILD_MONTHS (任意, "1" なら対象月のCSVを作り直す)
-- STATE_FILE (任意, 既定: state/downloaded_files.json)
+- STATE_PRESERVED (任意, REBUILD_MONTHS=1 と併用。月別CSVを消さずに全件を取り直し、既存と同じ行は追記しない)
+- STATE_FILE (任意, 既定: state/downloaded_files.log)
+- STATE_COMPACT_BYTES (任意, 既定: 1048576。state がこのサイズを超え、かつ前回詰め直した時の2倍を超えたら、重複除去＋ソートで詰め直す)
+- FTP_PARALLEL (任意, 既定: 4。同時ダウンロード数＝FTP接続数)
+- KEEP_RAW (任意, "1" なら取得した raw CSV を raw/ にも保存する。デバッグ用)
+- RAW_FORMAT (任意, "zst" なら raw CSV を月ごとの raw/YYYY-MM.tar.zst に圧縮して残す。zstandard が必要)
+- FTP_MODE_Z (任意, auto|on|off, 既定: auto。MODE Z(deflate) 転送を使うか。on は非対応ならエラー)
+- FTP_SOCK_BUF (任意, 既定: 0。データ接続の SO_RCVBUF/SO_SNDBUF バイト数, 0 なら変更しない)
+  ※ Linux では値を指定するとそのソケットの受信バッファ自動調整が止まり、net.core.rmem_max で頭打ちになる。
+    既定(0)の自動調整の方が速いことが多いので、rmem_max を上げた環境で効果を確認してから使うこと。
+- FTP_KEEPALIVE_SEC (任意, 既定: 20。この秒数アイドルな制御接続に NOOP を送る, 0 で無効)
+- FTP_MULTIPART_MIN_BYTES (任意, 既定: 10485760。これ以上のファイルは REST で分割して並列取得, 0 で無効)
+- FTP_MULTIPART_PARTS (任意, 既定: 4。分割取得の分割数＝追加で張る接続数)
+- STATE_CHECKPOINT_EVERY (任意, 既定: 16。この件数の追記ごとに state を保存する)
+- ASYNC_FTP (任意, "1" なら aioftp でダウンロードとCSV追記を並行させる。aioftp が必要)
 
 出力:
 - data/YYYY-MM.csv
-- state/downloaded_files.json  （処理済みファイル名のリスト）
+- data/YYYY-MM.idx  （実行中だけ存在する追記記録: ファイル名\t追記後のバイト位置\t行数。
+  先頭行はファイル名が空で、開いた時点のサイズ。正常終了時に正規化の前に削除）
+- state/downloaded_files.log  （処理済みファイル名の追記型ジャーナル, 1行1ファイル名）
+- state/downloaded_files.watermark  （処理済みとみなせる MLSD modify の上限, YYYYMMDDHHMMSS）
 - log/rtmk_sync.log
 
 注意:
 - GitHub Actions は毎回クリーン環境なので、増分運用には state をコミットして保持します。
-  （workflow 側で data/*.csv と state/*.json を add/commit してください）
+  （workflow 側で data/*.csv と state/ を add/commit してください）
+- 途中で落ちて data/*.idx が残っていた場合は、次回起動時に idx のファイルを処理済みとして state に取り込み、
+  最後に記録した位置より後ろ（書きかけの行）を月別CSVから切り詰めてから続行します。
+- 旧形式の state/downloaded_files.json があり .log が無い場合は、初回読み込み時に .log へ移行します。
 """
 
 from __future__ import annotations
 
+import asyncio
 import csv
 import datetime as dt
 import ftplib
+import functools
 import io
 import json
+import logging
 import os
+import re
+import socket
+import sys
+import tarfile
+import threading
 import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional, Set, Tuple
+from typing import IO, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+try:
+    import aioftp  # 任意: ASYNC_FTP=1 のときだけ使う
+except ImportError:  # pragma: no cover
+    aioftp = None
+
+try:
+    import zstandard  # 任意: RAW_FORMAT=zst のときだけ使う
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import xxhash  # 任意: 行の重複判定を速くする
+except ImportError:  # pragma: no cover
+    xxhash = None
 
 
 # ----------------------------
@@ -55,116 +100,330 @@ CONFIG = {
 
     # 初回再構築（Trueだと対象月CSVを一旦削除して作り直す）
     "rebuild_months": _env("REBUILD_MONTHS", "0") in ("1", "true", "TRUE", "yes", "YES"),
+    # 再構築時に既存の月別CSVを残し、行単位で重複を除いて追記する
+    "state_preserved": _env("STATE_PRESERVED", "0") in ("1", "true", "TRUE", "yes", "YES"),
 
     # 状態ファイル（増分用）: repo内に置くのがポイント
-    "state_file": _env("STATE_FILE", "state/downloaded_files.json"),
+    "state_file": _env("STATE_FILE", "state/downloaded_files.log"),
+    "state_compact_bytes": int(_env("STATE_COMPACT_BYTES", str(1 << 20))),
+    # 途中で落ちても取り直しが少なくて済むよう、K 件ごとに state を追記保存する
+    "state_checkpoint_every": max(1, int(_env("STATE_CHECKPOINT_EVERY", "16"))),
 
     # タイムアウト・リトライ
     "connect_timeout": int(_env("FTP_CONNECT_TIMEOUT", "10")),
     "transfer_timeout": int(_env("FTP_TRANSFER_TIMEOUT", "20")),
     "connect_retries": int(_env("FTP_CONNECT_RETRIES", "3")),
     "retry_sleep_sec": float(_env("FTP_RETRY_SLEEP", "2.0")),
+
+    # 並列ダウンロード数（スレッドごとに独立したFTP接続を持つ）
+    "ftp_parallel": max(1, int(_env("FTP_PARALLEL", "4"))),
+
+    # raw CSV をディスクにも残すか（既定はメモリ上で処理して保存しない）
+    "keep_raw": _env("KEEP_RAW", "0") in ("1", "true", "TRUE", "yes", "YES"),
+    # raw の保存形式: "zst" なら月別の tar.zst アーカイブ（KEEP_RAW 不要）
+    "raw_format": _env("RAW_FORMAT", "").lower(),
+
+    # aioftp による非同期ダウンロード（ダウンロードとCSV追記を重ねる）
+    "async_ftp": _env("ASYNC_FTP", "0") in ("1", "true", "TRUE", "yes", "YES"),
+
+    # MODE Z（zlib 圧縮転送）: auto=対応していれば使う / on=必須 / off=使わない
+    "ftp_mode_z": _env("FTP_MODE_Z", "auto").lower(),
+
+    # データ接続のソケットバッファ（0=カーネルの自動調整に任せる）と RETR の読み込み単位
+    "ftp_sock_buf": int(_env("FTP_SOCK_BUF", "0")),
+    "retr_blocksize": 1 << 20,
+
+    # アイドルな制御接続がサーバに切られないよう NOOP を送る間隔
+    "keepalive_sec": float(_env("FTP_KEEPALIVE_SEC", "20")),
+
+    # 大きいファイルは REST <offset> で分割し、複数接続で同時に取得する
+    "multipart_min_bytes": int(_env("FTP_MULTIPART_MIN_BYTES", str(10 * 1024 * 1024))),
+    "multipart_parts": max(1, int(_env("FTP_MULTIPART_PARTS", "4"))),
 }
 
 s = (CONFIG.get("start_from_date") or "").strip()[:10]
 START_DATE = dt.datetime.strptime(s, "%Y-%m-%d").date()
+START_YMD = (START_DATE.year, START_DATE.month, START_DATE.day)
+
+# raw の保存先: RAW_FORMAT=zst なら月別アーカイブ、zstandard が無ければ個別ファイルで代用
+RAW_ARCHIVE = CONFIG["raw_format"] == "zst" and zstandard is not None
+KEEP_RAW_FILES = (CONFIG["keep_raw"] or CONFIG["raw_format"] == "zst") and not RAW_ARCHIVE
+
+# 行単位の重複除去は REBUILD_MONTHS=1 かつ STATE_PRESERVED=1 のときだけ
+DEDUP_ROWS = CONFIG["rebuild_months"] and CONFIG["state_preserved"]
 
 
 RAW_DIR = ROOT / "raw"
 DATA_DIR = ROOT / "data"
 LOG_DIR = ROOT / "log"
 STATE_PATH = ROOT / CONFIG["state_file"]
+# 旧既定の STATE_FILE=...json が明示されていても、ジャーナルは .log に書き、.json は移行元として扱う
+if STATE_PATH.suffix == ".json":
+    STATE_PATH = STATE_PATH.with_suffix(".log")
+WATERMARK_PATH = STATE_PATH.with_suffix(".watermark")
 
 
 # ----------------------------
 # ログ / 便利関数
 # ----------------------------
-def now_str() -> str:
-    return dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-def log(msg: str) -> None:
-    line = f"[{now_str()}] {msg}"
-    print(line, flush=True)
+def _setup_logger() -> logging.Logger:
+    """ログファイルは1度だけ開いて使い回す（logging はスレッドセーフ）"""
+    lg = logging.getLogger("rtmk")
+    if lg.handlers:
+        return lg
+    lg.setLevel(logging.INFO)
+    lg.propagate = False
+    fmt = logging.Formatter("[%(asctime)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
     LOG_DIR.mkdir(parents=True, exist_ok=True)
-    with (LOG_DIR / "rtmk_sync.log").open("a", encoding="utf-8") as f:
-        f.write(line + "\n")
+    for h in (
+        logging.FileHandler(LOG_DIR / "rtmk_sync.log", encoding="utf-8", delay=True),
+        logging.StreamHandler(sys.stdout),
+    ):
+        h.setFormatter(fmt)
+        lg.addHandler(h)
+    return lg
+
+logger = _setup_logger()
 
 def ensure_dirs() -> None:
-    RAW_DIR.mkdir(parents=True, exist_ok=True)
+    if KEEP_RAW_FILES or RAW_ARCHIVE:
+        RAW_DIR.mkdir(parents=True, exist_ok=True)
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     LOG_DIR.mkdir(parents=True, exist_ok=True)
     STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
 
-def load_state() -> List[str]:
-    if not STATE_PATH.exists():
-        return []
+# 最後に詰め直した（または読み込んだ時点の重複なしの）state のバイト数
+_STATE_INFO = {"compacted_bytes": 0}
+
+def _write_state_compacted(files: Set[str]) -> None:
+    tmp_path = STATE_PATH.with_name(STATE_PATH.name + ".tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        for name in sorted(files):
+            f.write(name + "\n")
+    tmp_path.replace(STATE_PATH)
+    _STATE_INFO["compacted_bytes"] = STATE_PATH.stat().st_size
+
+def _migrate_json_state(src: Path) -> Set[str]:
+    """旧形式（JSON 配列）の state を読んで .log に書き直す。読めなければ止める。"""
     try:
-        with STATE_PATH.open("r", encoding="utf-8") as f:
+        with src.open("r", encoding="utf-8") as f:
             v = json.load(f)
-        return v if isinstance(v, list) else []
+    except Exception as e:
+        raise RuntimeError(f"旧形式の state を読めません: {src} ({e})")
+    if not isinstance(v, list):
+        raise RuntimeError(f"旧形式の state が配列ではありません: {src}")
+    files = set(str(n) for n in v)
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    _write_state_compacted(files)
+    if src != STATE_PATH:
+        src.unlink()
+    logger.info(f"[state] migrated {src.name} -> {STATE_PATH.name} ({len(files)} files)")
+    return files
+
+def load_state() -> Set[str]:
+    """処理済みファイル名を読む（1行1ファイル名）。
+    - .log が無く旧形式の .json があれば、それを読んで .log に移行する。
+    - .log の中身が JSON 配列（旧形式）なら、その場で .log 形式に書き直す。
+    - 読めなければ止める（空として扱うと全件取り直しや、詰め直しでの履歴消失になる）。
+    """
+    if STATE_PATH.exists():
+        try:
+            with STATE_PATH.open("r", encoding="utf-8") as f:
+                head = f.read(64).lstrip()
+                if head.startswith("["):
+                    files = None
+                else:
+                    f.seek(0)
+                    files = set(line.rstrip("\r\n") for line in f if line.strip())
+        except Exception as e:
+            raise RuntimeError(f"state を読めません: {STATE_PATH} ({e})")
+        if files is None:
+            return _migrate_json_state(STATE_PATH)
+        _STATE_INFO["compacted_bytes"] = sum(len(n.encode("utf-8")) + 1 for n in files)
+        return files
+
+    legacy = STATE_PATH.with_suffix(".json")
+    if not legacy.exists():
+        return set()
+    return _migrate_json_state(legacy)
+
+def save_state_append(new_files: List[str]) -> None:
+    """今回処理したファイル名だけを追記する。
+    - 閾値を超え、かつ前回詰め直した時の2倍を超えたら詰め直す（毎回の全書き換えを避ける）。
+    """
+    if not new_files:
+        return
+    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with STATE_PATH.open("a", encoding="utf-8") as f:
+        for name in new_files:
+            f.write(name + "\n")
+    size = STATE_PATH.stat().st_size
+    if size > max(CONFIG["state_compact_bytes"], 2 * _STATE_INFO["compacted_bytes"]):
+        compact_state()
+
+def load_watermark() -> str:
+    try:
+        v = WATERMARK_PATH.read_text(encoding="utf-8").strip()
     except Exception:
-        return []
+        return ""
+    return v if len(v) == 14 and v.isdigit() else ""
 
-def save_state(files: List[str]) -> None:
-    STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with STATE_PATH.open("w", encoding="utf-8") as f:
-        json.dump(sorted(set(files)), f, ensure_ascii=False, indent=2)
+def save_watermark(v: str) -> None:
+    WATERMARK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    WATERMARK_PATH.write_text(v + "\n", encoding="utf-8")
+
+def next_watermark(current: str, remote: Dict[str, str], files: List[str], results: List[bool]) -> str:
+    """今回の結果から次の watermark を決める。
+    - 成功したファイルの modify の最大値まで進める。
+    - ただし失敗したファイルがあれば、その modify より手前で止める（次回も一覧に出るように）。
+    """
+    failed = [remote.get(f, "") for f, r in zip(files, results) if not r]
+    if any(not m for m in failed):
+        return current
+    limit = min(failed) if failed else None
+    wm = current
+    for f, r in zip(files, results):
+        m = remote.get(f, "")
+        if r and m and m > wm and (limit is None or m < limit):
+            wm = m
+    return wm
+
+def compact_state() -> None:
+    """重複除去＋ソートして state を書き直す（読み込みに失敗したら書き直さない）。"""
+    try:
+        files = load_state()
+    except RuntimeError as e:
+        logger.warning(f"[WARN] [state] compaction skipped: {e}")
+        return
+    before = STATE_PATH.stat().st_size
+    _write_state_compacted(files)
+    logger.info(f"[state] compacted {STATE_PATH.name}: {before} -> {STATE_PATH.stat().st_size} bytes")
 
+# <局ID>_<YYYYMMDD>[T]<HHMMSS>...  （2つ目の "_" 区切り以降の時刻部分を取り出す）
+_FNAME_RE = re.compile(r"[^_]*_(\d{8})T?(\d{6})", re.ASCII)
+
+@functools.lru_cache(maxsize=16384)
 def extract_datetime_from_fname(fname: str) -> Optional[dt.datetime]:
     """
     対応例:
       235_20251219T170000.CSV -> 2025-12-19 17:00:00
       D000_20250616115008.CSV -> 2025-06-16 11:50:08
+    コンパイル済み正規表現で時刻部分を取り出し、固定位置をスライスして int 化する。
+    同じファイル名を何度も解析するため結果をキャッシュする。
     """
-    base = os.path.splitext(fname)[0]
-    parts = base.split("_")
-    if len(parts) < 2:
+    m = _FNAME_RE.match(fname)
+    if not m:
         return None
-    tail = parts[1]
-
-    # 20251219T170000
-    try:
-        if len(tail) >= 15 and tail[8] == "T":
-            return dt.datetime.strptime(tail[:15], "%Y%m%dT%H%M%S")
-    except Exception:
-        pass
-
-    # 20250616115008
+    date_s, time_s = m.groups()
     try:
-        if tail[:14].isdigit():
-            return dt.datetime.strptime(tail[:14], "%Y%m%d%H%M%S")
-    except Exception:
-        pass
-
-    return None
-
-def file_in_scope(fname: str) -> bool:
-    dttm = extract_datetime_from_fname(fname)
-    return bool(dttm and dttm.date() >= START_DATE)
+        return dt.datetime(
+            int(date_s[0:4]), int(date_s[4:6]), int(date_s[6:8]),
+            int(time_s[0:2]), int(time_s[2:4]), int(time_s[4:6]),
+        )
+    except ValueError:
+        return None
 
-def year_month_for(fname: str) -> str:
+def classify(fname: str) -> Optional[Tuple[bool, str, dt.datetime]]:
+    """ファイル名を1回だけ解析して (対象期間内か, "YYYY-MM", 日時) を返す。解析できなければ None。"""
     dttm = extract_datetime_from_fname(fname)
-    if not dttm:
-        now = dt.datetime.now()
-        return f"{now.year}-{now.month:02d}"
-    return f"{dttm.year}-{dttm.month:02d}"
+    if dttm is None:
+        return None
+    ymd = (dttm.year, dttm.month, dttm.day)
+    return (ymd >= START_YMD, f"{dttm.year}-{dttm.month:02d}", dttm)
 
 def month_path(ym: str) -> Path:
     return DATA_DIR / f"{ym}.csv"
 
+def index_path(ym: str) -> Path:
+    return DATA_DIR / f"{ym}.idx"
+
 
 # ----------------------------
 # FTP
 # ----------------------------
-def ftp_connect() -> ftplib.FTP:
+def tune_socket(sock: socket.socket, buffers: bool = False) -> None:
+    """Nagle を切り、buffers=True なら送受信バッファを FTP_SOCK_BUF にする（失敗しても転送自体は続ける）
+    - バッファはウィンドウスケールに効くよう connect() 前のソケットに対してだけ設定する。
+    """
+    buf = CONFIG["ftp_sock_buf"]
+    try:
+        if buffers and buf > 0:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buf)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buf)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError as e:
+        logger.info(f"setsockopt failed: {e}")
+
+def _create_tuned_connection(
+    address: Tuple[str, int], timeout: Optional[float], source_address: Any = None,
+) -> socket.socket:
+    """socket.create_connection と同じだが、connect() の前にバッファを設定する"""
+    host, port = address
+    last_err: Optional[OSError] = None
+    for af, socktype, proto, _, sa in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+        sock = socket.socket(af, socktype, proto)
+        try:
+            tune_socket(sock, buffers=True)
+            if timeout is not None:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except OSError as e:
+            last_err = e
+            sock.close()
+    raise last_err or OSError(f"getaddrinfo returned no address for {host}:{port}")
+
+class RtmkFTP(ftplib.FTP):
+    """ftplib.FTP + 接続ごとの転送モード（MODE Z 有効か）＋ソケット調整
+    - cmd_lock / last_used は keepalive（NOOP）と転送が同時に走らないようにするためのもの
+    """
+
+    mode_z = False
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.cmd_lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+    def connect(self, *args: Any, **kwargs: Any) -> str:
+        resp = super().connect(*args, **kwargs)
+        tune_socket(self.sock)
+        return resp
+
+    def ntransfercmd(self, cmd: str, rest: Any = None) -> Tuple[socket.socket, Optional[int]]:
+        if CONFIG["ftp_sock_buf"] <= 0 or not self.passiveserver:
+            conn, size = super().ntransfercmd(cmd, rest)
+            tune_socket(conn)
+            return conn, size
+
+        # PASV のデータ接続を自前で張り、connect() 前にバッファを設定する（手順は ftplib と同じ）
+        host, port = self.makepasv()
+        conn = _create_tuned_connection((host, port), self.timeout, self.source_address)
+        try:
+            if rest is not None:
+                self.sendcmd(f"REST {rest}")
+            resp = self.sendcmd(cmd)
+            if resp[0] == "2":
+                resp = self.getresp()
+            if resp[0] != "1":
+                raise ftplib.error_reply(resp)
+        except BaseException:
+            conn.close()
+            raise
+        size = ftplib.parse150(resp) if resp[:3] == "150" else None
+        return conn, size
+
+def ftp_connect() -> RtmkFTP:
     if not CONFIG["ftp_host"] or not CONFIG["ftp_user"] or not CONFIG["ftp_pass"]:
         raise RuntimeError("FTP_HOST/FTP_USER/FTP_PASS が未設定です（GitHub Secrets/Env を確認）")
 
     last_err: Optional[Exception] = None
     for attempt in range(1, CONFIG["connect_retries"] + 1):
         try:
-            log(f"Connecting to FTP... (attempt {attempt}/{CONFIG['connect_retries']})")
-            ftp = ftplib.FTP()
+            logger.info(f"Connecting to FTP... (attempt {attempt}/{CONFIG['connect_retries']})")
+            ftp = RtmkFTP()
             ftp.connect(CONFIG["ftp_host"], CONFIG["ftp_port"], timeout=CONFIG["connect_timeout"])
             ftp.login(CONFIG["ftp_user"], CONFIG["ftp_pass"])
             ftp.set_pasv(True)  # 多くの環境で安定
@@ -173,57 +432,449 @@ def ftp_connect() -> ftplib.FTP:
             return ftp
         except Exception as e:
             last_err = e
-            log(f"FTP connect failed: {e}")
+            logger.info(f"FTP connect failed: {e}")
             time.sleep(CONFIG["retry_sleep_sec"])
     raise RuntimeError(f"FTP接続に失敗しました: {last_err}")
 
-def list_remote_csv(ftp: ftplib.FTP) -> List[str]:
-    """リモートCSV一覧を取得（順序が不定なため、ファイル名から時刻を推定してソートする）"""
-    names = ftp.nlst()  # cwd 済み想定
-    csvs = [n for n in names if n.lower().endswith(".csv")]
+def negotiate_mode_z(ftp: RtmkFTP) -> bool:
+    """MODE Z を要求する。一覧取得(MLSD/NLST)には使わず、RETR 専用の接続でだけ呼ぶ。"""
+    setting = CONFIG["ftp_mode_z"]
+    if setting in ("off", "0", "false", "no"):
+        return False
+    try:
+        resp = ftp.sendcmd("MODE Z")
+        ftp.mode_z = resp.startswith("2")
+    except ftplib.Error as e:
+        # 4xx/5xx などの否定応答はすべて「非対応」として扱う
+        ftp.mode_z = False
+        resp = str(e)
+    if not ftp.mode_z and setting in ("on", "1", "true", "yes"):
+        raise RuntimeError(f"MODE Z が使えません: {resp}")
+    return ftp.mode_z
+
+def keepalive_loop(conns: Callable[[], List[RtmkFTP]], stop: threading.Event, interval: float) -> None:
+    """interval 秒以上使われていない制御接続に NOOP を送る（転送中の接続には触らない）"""
+    while not stop.wait(min(interval, 5.0)):
+        now = time.monotonic()
+        for conn in conns():
+            if now - conn.last_used < interval or not conn.cmd_lock.acquire(blocking=False):
+                continue
+            try:
+                if conn.sock is None:
+                    continue  # ワーカー側で閉じた接続
+                conn.voidcmd("NOOP")
+                conn.last_used = time.monotonic()
+            except Exception as e:
+                logger.info(f"NOOP failed: {e}")
+            finally:
+                conn.cmd_lock.release()
+
+def ftp_close(ftp: ftplib.FTP) -> None:
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+def _parse_mlsd_modify(v: Optional[str]) -> Optional[dt.datetime]:
+    # MLSD の modify は UTC の YYYYMMDDHHMMSS[.sss]
+    if not v:
+        return None
+    try:
+        return dt.datetime.strptime(v[:14], "%Y%m%d%H%M%S")
+    except Exception:
+        return None
+
+def list_remote_csv(
+    ftp: ftplib.FTP, watermark: str = "", sizes: Optional[Dict[str, int]] = None,
+) -> Dict[str, str]:
+    """リモートCSV一覧を取得（順序が不定なため、ファイル名から時刻を推定してソートする）
+    - MLSD 対応サーバでは1回の一覧取得で name + modify を得て、
+      START_DATE より前に更新されたファイルはファイル名を解析せずに除外する。
+    - watermark より前に更新されたファイルも処理済みとして除外する
+      （同じ秒に更新されたものは取りこぼさないよう残し、state で弾く）。
+    - MLSD 非対応なら NLST にフォールバックする（modify は空文字）。
+    - sizes を渡すと MLSD の size をそこに入れる（分割取得の判定用）。
+    戻り値: {ファイル名: modify(YYYYMMDDHHMMSS or "")}
+    """
+    entries: Dict[str, str] = {}
+    # modify は UTC・ファイル名はローカル時刻なので1日の余裕を持たせる
+    min_modify = START_DATE - dt.timedelta(days=1)
+    try:
+        for name, facts in ftp.mlsd(facts=["type", "modify", "size"]):  # cwd 済み想定
+            if facts.get("type", "file") != "file" or not name.lower().endswith(".csv"):
+                continue
+            modify = _parse_mlsd_modify(facts.get("modify"))
+            if modify is not None and modify.date() < min_modify:
+                continue
+            m = (facts.get("modify") or "")[:14] if modify is not None else ""
+            if watermark and m and m < watermark:
+                continue
+            entries[name] = m
+            if sizes is not None and (facts.get("size") or "").isdigit():
+                sizes[name] = int(facts["size"])
+    except ftplib.error_perm as e:
+        logger.info(f"MLSD not supported, fallback to NLST: {e}")
+        entries = {n: "" for n in ftp.nlst() if n.lower().endswith(".csv")}
+    csvs = list(entries)
 
     def _key(n: str) -> Tuple[int, dt.datetime]:
         d = extract_datetime_from_fname(n)
         # 推定できないものは後ろに回す
         return (0 if d else 1, d or dt.datetime.max)
 
-    return sorted(csvs, key=_key)
+    return {n: entries[n] for n in sorted(csvs, key=_key)}
+
+async def _aioftp_connect() -> Any:
+    last_err: Optional[Exception] = None
+    for attempt in range(1, CONFIG["connect_retries"] + 1):
+        client = aioftp.Client(socket_timeout=CONFIG["transfer_timeout"])
+        try:
+            logger.info(f"Connecting to FTP (async)... (attempt {attempt}/{CONFIG['connect_retries']})")
+            await asyncio.wait_for(
+                client.connect(CONFIG["ftp_host"], CONFIG["ftp_port"]),
+                timeout=CONFIG["connect_timeout"],
+            )
+            await client.login(CONFIG["ftp_user"], CONFIG["ftp_pass"])
+            await client.change_directory(CONFIG["ftp_dir"])
+            return client
+        except Exception as e:
+            last_err = e
+            logger.info(f"FTP connect failed: {e}")
+            client.close()
+            await asyncio.sleep(CONFIG["retry_sleep_sec"])
+    raise RuntimeError(f"FTP接続に失敗しました: {last_err}")
+
+async def async_download_all(files: List[str], merge: Callable[[str, bytes], None]) -> List[bool]:
+    """aioftp の接続を K 本張ってダウンロードし、CSV追記は別スレッドで並行して行う。
+    - ダウンローダ K 個 → asyncio.Queue(maxsize=2K) → 追記コンシューマ1個
+    - merge(fname, raw_bytes) は同期関数（失敗時は例外を投げる）
+    戻り値: files と同じ順序の成否リスト
+    """
+    k = max(1, min(CONFIG["ftp_parallel"], len(files)))
+    names: asyncio.Queue = asyncio.Queue()
+    for i, f in enumerate(files):
+        names.put_nowait((i, f))
+    done: asyncio.Queue = asyncio.Queue(maxsize=2 * k)
+    results = [False] * len(files)
+    loop = asyncio.get_running_loop()
+
+    async def _downloader() -> None:
+        client = None
+        try:
+            while True:
+                try:
+                    i, f = names.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    if client is None:
+                        client = await _aioftp_connect()
+                    logger.info(f"Downloading {f}")
+                    buf = io.BytesIO()
+                    async with client.download_stream(f) as stream:
+                        async for block in stream.iter_by_block():
+                            buf.write(block)
+                    data = buf.getvalue()
+                    if KEEP_RAW_FILES:
+                        (RAW_DIR / f).write_bytes(data)
+                    await done.put((i, f, data))
+                except Exception as e:
+                    logger.warning(f"[WARN] failed {f}: {e}")
+                    # 接続が壊れている可能性があるので張り直す
+                    if client is not None:
+                        client.close()
+                        client = None
+        finally:
+            if client is not None:
+                try:
+                    await client.quit()
+                except Exception:
+                    client.close()
+
+    async def _consumer() -> None:
+        while True:
+            item = await done.get()
+            if item is None:
+                return
+            i, f, data = item
+            try:
+                await loop.run_in_executor(None, merge, f, data)
+                results[i] = True
+            except Exception as e:
+                logger.warning(f"[WARN] failed {f}: {e}")
+
+    consumer = asyncio.create_task(_consumer())
+    await asyncio.gather(*(_downloader() for _ in range(k)))
+    await done.put(None)
+    await consumer
+    return results
 
 
 # ----------------------------
 # Download & merge
 # ----------------------------
-def download_file(ftp: ftplib.FTP, fname: str) -> Path:
-    local_path = RAW_DIR / fname
-    with local_path.open("wb") as lf:
-        ftp.retrbinary(f"RETR {fname}", lf.write)
-    return local_path
+def download_file(ftp: ftplib.FTP, fname: str) -> bytes:
+    """RETR の内容をメモリ上に受け取って返す（KEEP_RAW=1 のときだけ raw/ にも書く）
+    - MODE Z の接続では受信しながら zlib 展開する。
+    """
+    buf = io.BytesIO()
+    if getattr(ftp, "mode_z", False):
+        decomp = zlib.decompressobj()
+        ftp.retrbinary(
+            f"RETR {fname}", lambda chunk: buf.write(decomp.decompress(chunk)),
+            blocksize=CONFIG["retr_blocksize"],
+        )
+        buf.write(decomp.flush())
+    else:
+        ftp.retrbinary(f"RETR {fname}", buf.write, blocksize=CONFIG["retr_blocksize"])
+    data = buf.getvalue()
+    if KEEP_RAW_FILES:
+        (RAW_DIR / fname).write_bytes(data)
+    return data
+
+class RawArchive:
+    """raw CSV を raw/YYYY-MM.tar.zst に追記する。
+    - 実行ごとに1つの zstd フレーム（中身は tar）を末尾に足していく。
+    - 展開は `zstd -dc raw/YYYY-MM.tar.zst | tar -xi`（tar の終端ブロックが複数あるため -i が必要）。
+    """
+
+    def __init__(self, ym: str) -> None:
+        self.path = RAW_DIR / f"{ym}.tar.zst"
+        self._zw: Any = None
+        self._tar: Optional[tarfile.TarFile] = None
+
+    def add(self, fname: str, data: bytes) -> None:
+        if self._tar is None:
+            self._zw = zstandard.ZstdCompressor(level=3).stream_writer(self.path.open("ab"))
+            self._tar = tarfile.open(fileobj=self._zw, mode="w|", format=tarfile.PAX_FORMAT)
+        info = tarfile.TarInfo(fname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def close(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            self._zw.close()
+            self._tar = None
+            self._zw = None
+
+def _row_hash(r: List[str]) -> int:
+    if xxhash is not None:
+        return xxhash.xxh3_64_intdigest(",".join(r).encode("utf-8"))
+    return hash(tuple(r))
+
+def _load_row_hashes(ym: str) -> Set[int]:
+    """既存の月別CSVのデータ行（ヘッダ除く）のハッシュ集合"""
+    p = month_path(ym)
+    if not p.exists():
+        return set()
+    with p.open("r", newline="", encoding="utf-8", errors="ignore") as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return set(_row_hash(r) for r in reader if r)
+
+def _retr_range(fname: str, offset: int, out: memoryview) -> None:
+    """専用の接続で REST offset → RETR し、len(out) バイト受け取ったら切る"""
+    conn = ftp_connect()
+    try:
+        conn.voidcmd("TYPE I")
+        got = 0
+        with conn.transfercmd(f"RETR {fname}", rest=offset) as sock:
+            while got < len(out):
+                n = sock.recv_into(out[got:], min(len(out) - got, CONFIG["retr_blocksize"]))
+                if n == 0:
+                    break
+                got += n
+        if got < len(out):
+            raise RuntimeError(f"short read at offset {offset}: {got}/{len(out)} bytes")
+        try:
+            conn.voidresp()
+        except ftplib.Error:
+            pass  # 途中で切ったので 426 などが返ることがある（データは受信済み）
+    finally:
+        ftp_close(conn)
 
-def append_raw_to_monthly(raw_path: Path, ym: str) -> int:
+def download_file_multipart(fname: str, size: Optional[int] = None, parts: int = 4, ftp: Optional[ftplib.FTP] = None) -> bytes:
+    """1つの大きいファイルを parts 個の接続で REST/RETR 分割取得してメモリ上で結合する。
+    - size が分からなければ ftp で SIZE を問い合わせ、それでも分からなければ ftp で普通に取得する。
+    """
+    if size is None:
+        if ftp is None:
+            raise ValueError("size か ftp のどちらかが必要です")
+        try:
+            ftp.voidcmd("TYPE I")
+            size = ftp.size(fname)
+        except ftplib.Error:
+            size = None
+        if size is None:
+            return download_file(ftp, fname)
+    if size <= 0:
+        data = b""
+        if KEEP_RAW_FILES:
+            (RAW_DIR / fname).write_bytes(data)
+        return data
+    parts = max(1, min(parts, size // CONFIG["retr_blocksize"] + 1))
+    buf = bytearray(size)
+    view = memoryview(buf)
+    step = -(-size // parts)
+    ranges = [(off, min(step, size - off)) for off in range(0, size, step)]
+    with ThreadPoolExecutor(max_workers=len(ranges), thread_name_prefix="rtmk-part") as ex:
+        for fut in [ex.submit(_retr_range, fname, off, view[off:off + n]) for off, n in ranges]:
+            fut.result()
+    data = bytes(buf)
+    if KEEP_RAW_FILES:
+        (RAW_DIR / fname).write_bytes(data)
+    return data
+
+class MonthlyWriter:
+    """1つの月別CSVを初回書き込み時に1度だけ開き、以降の追記で使い回す。
+    - ヘッダは新規ファイルのときだけ、最初の1回だけ書く。
+    - 月ごとのロックを持つので、複数スレッドから同じ月へ追記してよい。
+    - dedup=True なら既存行のハッシュを読み込み、同じ行は追記しない（seen）。
+    - exists を渡すとファイルの有無を stat せずにそれを使う（起動時の scandir 結果）。
+    - index=True のときだけ data/YYYY-MM.idx に追記記録を残す（後始末する main() 用）。
+    """
+
+    def __init__(
+        self, ym: str, dedup: bool = False, exists: Optional[bool] = None, index: bool = False,
+    ) -> None:
+        self.ym = ym
+        self.path = month_path(ym)
+        self.lock = threading.Lock()
+        self.dedup = dedup
+        self.exists = exists
+        self.index = index
+        self.seen: Optional[Set[int]] = None
+        self._f: Optional[IO[str]] = None
+        self._w: Any = None
+        self._ix: Optional[IO[str]] = None
+        self._need_header = False
+
+    def writer(self, header: List[str]) -> Any:
+        if self._f is None:
+            exists = self.path.exists() if self.exists is None else self.exists
+            if self.dedup:
+                self.seen = _load_row_hashes(self.ym) if exists else set()
+            self._need_header = not exists
+            self._f = self.path.open("a", newline="", encoding="utf-8", buffering=1 << 20)
+            self._w = csv.writer(self._f)
+            self.exists = True
+            # 開いた時点のサイズを記録しておく（最初のファイルの途中で落ちても切り詰められるように）
+            self._write_index("", os.fstat(self._f.fileno()).st_size, 0)
+        if self._need_header:
+            self._w.writerow(header)
+            self._need_header = False
+        return self._w
+
+    def commit(self, fname: str, n_rows: int) -> None:
+        """1ファイル分の追記をディスクへ書き出し、index=True なら data/YYYY-MM.idx に記録する。"""
+        if self._f is not None:
+            self._f.flush()
+            offset = os.fstat(self._f.fileno()).st_size
+        else:
+            offset = self.path.stat().st_size if self.path.exists() else 0
+        self._write_index(fname, offset, n_rows)
+
+    def _write_index(self, fname: str, offset: int, n_rows: int) -> None:
+        if not self.index:
+            return
+        if self._ix is None:
+            self._ix = index_path(self.ym).open("a", encoding="utf-8", buffering=1)
+        self._ix.write(f"{fname}\t{offset}\t{n_rows}\n")
+
+    def close(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+            self._w = None
+        if self._ix is not None:
+            self._ix.close()
+            self._ix = None
+
+def read_index(ym: str) -> List[Tuple[str, int, int]]:
+    """data/YYYY-MM.idx を読む（壊れた行は無視）"""
+    entries: List[Tuple[str, int, int]] = []
+    try:
+        with index_path(ym).open("r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.rstrip("\r\n").split("\t")
+                if len(parts) == 3 and parts[1].isdigit() and parts[2].isdigit():
+                    entries.append((parts[0], int(parts[1]), int(parts[2])))
+    except FileNotFoundError:
+        pass
+    return entries
+
+def recover_from_index(state_set: Set[str]) -> None:
+    """前回の実行が途中で落ちて残った data/*.idx から復旧する。
+    - idx に載っているファイルは月別CSVへ追記済みなので state に取り込む。
+    - 最後に記録した位置より後ろ（idx に載る前に落ちたファイルの行）は切り詰める。
+      位置 0 まで戻す場合（ヘッダも書きかけ）はファイルごと消す。
+    - state を保存して idx を消してから、その月を正規化する。
+    """
+    for ix in sorted(DATA_DIR.glob("*.idx")):
+        ym = ix.stem
+        entries = read_index(ym)
+        p = month_path(ym)
+        if entries and p.exists():
+            end = entries[-1][1]
+            size = p.stat().st_size
+            if end == 0:
+                p.unlink()
+                logger.warning(f"[WARN] [recover] removed partial {p.name} ({size} bytes)")
+            elif size > end:
+                with p.open("r+b") as f:
+                    f.truncate(end)
+                logger.warning(f"[WARN] [recover] truncated {p.name}: {size} -> {end} bytes")
+        # 先頭の開始位置の行はファイル名が空
+        names = [e[0] for e in entries if e[0] and e[0] not in state_set]
+        state_set.update(names)
+        save_state_append(names)
+        ix.unlink()
+        logger.info(f"[recover] {ix.name}: {len(names)} files marked as done")
+        try:
+            normalize_monthly_csv(p)
+        except Exception as e:
+            logger.warning(f"[WARN] normalize failed {ym}: {e}")
+
+def append_raw_to_monthly(raw_bytes: bytes, ym: str, out: Optional[MonthlyWriter] = None) -> int:
     """
     1つの raw CSV から data行(ヘッダ除く)を月別CSVへ追記する。
+    out を渡すとその MonthlyWriter に書く（開きっぱなしのファイルを使い回す）。
     戻り値: 追記したデータ行数
     """
-    monthly_path = month_path(ym)
-
     # 文字コードは環境差があるので errors="ignore"
-    text = raw_path.read_text(encoding="utf-8", errors="ignore")
-    rows = list(csv.reader(io.StringIO(text)))
-    if not rows:
+    text = raw_bytes.decode("utf-8", errors="ignore")
+    # 行リストを作らずに1行ずつ読み書きする
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if header is None:
         return 0
 
-    header = rows[0]
-    data_rows = [r for r in rows[1:] if r]
-
-    exists = monthly_path.exists()
-    with monthly_path.open("a", newline="", encoding="utf-8") as mf:
-        w = csv.writer(mf)
-        if not exists:
-            w.writerow(header)
-        for r in data_rows:
-            w.writerow(r)
-    return len(data_rows)
+    mw = out if out is not None else MonthlyWriter(ym, dedup=DEDUP_ROWS)
+    n = 0
+
+    def _rows(seen: Optional[Set[int]]) -> Iterator[List[str]]:
+        nonlocal n
+        for r in reader:
+            if not r:
+                continue
+            if seen is not None:
+                h = _row_hash(r)
+                if h in seen:
+                    continue
+                seen.add(h)
+            n += 1
+            yield r
 
+    try:
+        w = mw.writer(header)
+        # writerows に生成器を渡す（行リストは作らない）
+        w.writerows(_rows(mw.seen))
+    finally:
+        if out is None:
+            mw.close()
+    return n
 
 
 def normalize_monthly_csv(monthly_path: Path) -> None:
@@ -273,79 +924,242 @@ def normalize_monthly_csv(monthly_path: Path) -> None:
 
     tmp_path.replace(monthly_path)
 
-def clear_target_month_files_if_rebuild(scope_files: List[str]) -> None:
-    if not CONFIG["rebuild_months"]:
+def clear_target_month_files_if_rebuild(months: Set[str]) -> None:
+    if not CONFIG["rebuild_months"] or DEDUP_ROWS:
         return
-    months = sorted(set(year_month_for(f) for f in scope_files))
-    for ym in months:
+    for ym in sorted(months):
         p = month_path(ym)
         if p.exists():
             p.unlink()
-            log(f"[rebuild] removed {p.name}")
+            logger.info(f"[rebuild] removed {p.name}")
 
 def main() -> None:
     ensure_dirs()
-    log("=== RTMK sync start ===")
-
-    state = load_state()
-    state_set: Set[str] = set(state)
+    logger.info("=== RTMK sync start ===")
+
+    state_set: Set[str] = load_state()
+    recover_from_index(state_set)
+    # まだ state ファイルに書いていない処理済みファイル
+    state_batch: List[str] = []
+
+    ftp: Optional[RtmkFTP] = None
+    # ワーカースレッドごとの FTP 接続（1スレッド1接続を使い回す）
+    tls = threading.local()
+    pool_conns: List[RtmkFTP] = []
+    pool_lock = threading.Lock()
+    state_lock = threading.Lock()
+    # 月別CSVは月ごとに1度だけ開く（ロックも月単位）
+    writers: Dict[str, MonthlyWriter] = {}
+    archives: Dict[str, RawArchive] = {}
+    ym_of: Dict[str, str] = {}
+    remote_sizes: Dict[str, int] = {}
+
+    # CSV追記は専用の1スレッドで行い、ダウンロード側はすぐ次の RETR に進む
+    # （未処理のダウンロード結果は backlog 個までに抑える）
+    parse_ex = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rtmk-parse")
+    backlog = threading.BoundedSemaphore(2 * CONFIG["ftp_parallel"])
+    stop_keepalive = threading.Event()
+    keepalive: Optional[threading.Thread] = None
+
+    def _stop_keepalive() -> None:
+        # 実行中の NOOP が終わるまで待ってから接続を閉じる
+        stop_keepalive.set()
+        if keepalive is not None:
+            keepalive.join()
+
+    def _live_conns() -> List[RtmkFTP]:
+        with pool_lock:
+            return ([ftp] if ftp else []) + list(pool_conns)
+
+    def _drop_worker_ftp(conn: RtmkFTP) -> None:
+        # conn.cmd_lock を持った状態で呼ぶ（keepalive の NOOP と重ならないように）
+        if getattr(tls, "ftp", None) is conn:
+            tls.ftp = None
+        with pool_lock:
+            if conn in pool_conns:
+                pool_conns.remove(conn)
+        ftp_close(conn)
+
+    def _worker_ftp() -> RtmkFTP:
+        conn = getattr(tls, "ftp", None)
+        if conn is None:
+            conn = ftp_connect()
+            tls.ftp = conn
+            with pool_lock:
+                pool_conns.append(conn)
+            with conn.cmd_lock:
+                try:
+                    if negotiate_mode_z(conn):
+                        logger.info("MODE Z enabled")
+                except Exception:
+                    _drop_worker_ftp(conn)
+                    raise
+        return conn
+
+    def _merge(f: str, raw_bytes: bytes) -> None:
+        ym = ym_of[f]
+        mw = writers[ym]
+        with mw.lock:
+            added = append_raw_to_monthly(raw_bytes, ym, mw)
+            mw.commit(f, added)
+            if ym in archives:
+                archives[ym].add(f, raw_bytes)
+        with state_lock:
+            state_set.add(f)
+            state_batch.append(f)
+            if len(state_batch) >= CONFIG["state_checkpoint_every"]:
+                _flush_state()
+        logger.info(f"merged -> {month_path(ym).name} (+{added}行)")
+
+    def _flush_state() -> None:
+        # state_lock を持った状態で呼ぶ
+        save_state_append(state_batch)
+        state_batch.clear()
+
+    def _merged(fut: Future, f: str) -> None:
+        backlog.release()
+        e = fut.exception()
+        if e is not None:
+            logger.warning(f"[WARN] failed {f}: {e}")
+
+    def _process(f: str) -> Optional[Future]:
+        try:
+            logger.info(f"Downloading {f}")
+            size = remote_sizes.get(f, 0)
+            if 0 < CONFIG["multipart_min_bytes"] <= size:
+                raw_bytes = download_file_multipart(f, size, CONFIG["multipart_parts"])
+            else:
+                conn = _worker_ftp()
+                with conn.cmd_lock:
+                    try:
+                        raw_bytes = download_file(conn, f)
+                    except Exception:
+                        # 接続が壊れている可能性があるので、次のファイルでは張り直す
+                        _drop_worker_ftp(conn)
+                        raise
+                    conn.last_used = time.monotonic()
+        except Exception as e:
+            # 分割取得の失敗はワーカーの接続とは無関係なので、接続はそのまま使い回す
+            logger.warning(f"[WARN] failed {f}: {e}")
+            return None
+        backlog.acquire()
+        fut = parse_ex.submit(_merge, f, raw_bytes)
+        fut.add_done_callback(lambda fu: _merged(fu, f))
+        return fut
 
-    ftp: Optional[ftplib.FTP] = None
     try:
         ftp = ftp_connect()
-        remote = list_remote_csv(ftp)
-        scope = [f for f in remote if file_in_scope(f)]
+        # 再構築時は対象月を全部取り直すので watermark を使わない
+        watermark = "" if CONFIG["rebuild_months"] else load_watermark()
+        remote = list_remote_csv(ftp, watermark, remote_sizes)
+        # ファイル名の解析は1回だけ（対象判定と月の振り分けを同時に行う）
+        classified = [(f, *r) for f in remote if (r := classify(f))]
+        ym_of.update((f, ym) for f, in_scope, ym, _ in classified if in_scope)
+        scope = list(ym_of)
+        if not scope and watermark:
+            logger.info("差分なし（watermark 以降に更新されたファイルなし）")
+            return
         if not scope:
-            log("対象期間のファイルが見つかりません（START_FROM_DATE/FTP_DIR を確認）")
+            logger.info("対象期間のファイルが見つかりません（START_FROM_DATE/FTP_DIR を確認）")
             return
 
-        clear_target_month_files_if_rebuild(scope)
+        clear_target_month_files_if_rebuild(set(ym_of.values()))
 
-        new_files = [f for f in scope if f not in state_set]
+        if DEDUP_ROWS:
+            # 月別CSVは残したまま全件取り直す（既存と同じ行は追記されない）
+            logger.info("[rebuild] STATE_PRESERVED=1: keep monthly CSVs and skip duplicate rows")
+            new_files = list(scope)
+        else:
+            # 差分は集合演算で求め、ファイル名の日時（キャッシュ済み）で時系列に並べる
+            new_files = sorted(set(scope) - state_set, key=extract_datetime_from_fname)
         if not new_files:
-            log("差分なし（新しいファイルなし）")
+            # 一覧に出たものは全て処理済みなので、その modify まで watermark を進める
+            new_wm = max((m for m in remote.values() if m), default=watermark)
+            if new_wm != watermark:
+                save_watermark(new_wm)
+            logger.info("差分なし（新しいファイルなし）")
             return
 
-        ok = 0
-        skipped = 0
-        touched_months: Set[str] = set()
+        # 月ごとにまとめてから処理する
+        by_month: Dict[str, List[str]] = {}
         for f in new_files:
-            ym = year_month_for(f)
-            touched_months.add(ym)
-            try:
-                log(f"Downloading {f}")
-                raw_path = download_file(ftp, f)
-                added = append_raw_to_monthly(raw_path, ym)
-                state_set.add(f)
-                ok += 1
-                log(f"merged -> {month_path(ym).name} (+{added}行)")
-            except Exception as e:
-                skipped += 1
-                log(f"[WARN] failed {f}: {e}")
-
+            by_month.setdefault(ym_of[f], []).append(f)
+        touched_months: Set[str] = set(by_month)
+        # 月別CSVの有無は1回の scandir でまとめて調べる（rebuild で消した後）
+        with os.scandir(DATA_DIR) as it:
+            existing_months = {e.name for e in it if e.is_file()}
+        for ym in by_month:
+            writers[ym] = MonthlyWriter(
+                ym, dedup=DEDUP_ROWS, exists=f"{ym}.csv" in existing_months, index=True,
+            )
+            if RAW_ARCHIVE:
+                archives[ym] = RawArchive(ym)
+        if CONFIG["raw_format"] == "zst" and not RAW_ARCHIVE:
+            logger.warning("[WARN] RAW_FORMAT=zst ですが zstandard が見つかりません（raw/ に個別ファイルで保存）")
+
+        ordered = [f for ym in sorted(by_month) for f in by_month[ym]]
+        workers = min(CONFIG["ftp_parallel"], len(ordered))
+        use_async = CONFIG["async_ftp"]
+        if use_async and aioftp is None:
+            logger.warning("[WARN] ASYNC_FTP=1 ですが aioftp が見つかりません（同期モードで続行）")
+            use_async = False
+        logger.info(f"{len(ordered)} files to download (parallel={workers}, async={use_async})")
+        try:
+            if use_async:
+                results = asyncio.run(async_download_all(ordered, _merge))
+            else:
+                if CONFIG["keepalive_sec"] > 0:
+                    keepalive = threading.Thread(
+                        target=keepalive_loop,
+                        args=(_live_conns, stop_keepalive, CONFIG["keepalive_sec"]),
+                        name="rtmk-keepalive", daemon=True,
+                    )
+                    keepalive.start()
+                with ThreadPoolExecutor(max_workers=workers) as ex:
+                    futures = list(ex.map(_process, ordered))
+                results = [fu is not None and fu.exception() is None for fu in futures]
+        finally:
+            _stop_keepalive()
+            parse_ex.shutdown(wait=True)
+            for mw in writers.values():
+                mw.close()
+            for ar in archives.values():
+                ar.close()
+        ok = sum(1 for r in results if r)
+        skipped = len(results) - ok
+
+        with state_lock:
+            _flush_state()
 
         # 月別CSVの時間順を保証（追記順に依存しない）
         for ym in sorted(touched_months):
+            # state に反映済みなので idx は不要。正規化で書き換えると
+            # idx のバイト位置は無意味になるため、正規化より先に消す
+            index_path(ym).unlink(missing_ok=True)
             try:
                 normalize_monthly_csv(month_path(ym))
-                log(f"normalized -> {month_path(ym).name}")
+                logger.info(f"normalized -> {month_path(ym).name}")
             except Exception as e:
-                log(f"[WARN] normalize failed {ym}: {e}")
-
-        save_state(list(state_set))
-        log(f"=== RTMK sync end (success) === ok={ok}, skipped={skipped}")
+                logger.warning(f"[WARN] normalize failed {ym}: {e}")
+        new_wm = next_watermark(watermark, remote, ordered, results)
+        if new_wm and new_wm != watermark:
+            save_watermark(new_wm)
+        logger.info(f"=== RTMK sync end (success) === ok={ok}, skipped={skipped}")
 
     except KeyboardInterrupt:
-        log("中断: KeyboardInterrupt（Ctrl+C）")
+        logger.info("中断: KeyboardInterrupt（Ctrl+C）")
     except Exception as e:
-        log(f"エラー終了: {e}")
+        logger.error(f"エラー終了: {e}")
         raise
     finally:
-        if ftp:
-            try:
-                ftp.quit()
-            except Exception:
-                pass
+        _stop_keepalive()
+        parse_ex.shutdown(wait=True)
+        # 異常終了でも、ここまでに追記できた分は state に残す
+        with state_lock:
+            _flush_state()
+        for conn in _live_conns():
+            with conn.cmd_lock:
+                ftp_close(conn)
 
 
 if __name__ == "__main__":